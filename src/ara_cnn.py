@@ -4,20 +4,38 @@ import os
 import logging
 import argparse
 
+from multiprocessing import cpu_count
+
+import numpy as np
+
 from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, TensorBoard, Callback
-from keras.layers import Input, GlobalAveragePooling2D, add, AveragePooling2D, Dense, Dropout
+from keras.layers import Input, GlobalAveragePooling2D, add, AveragePooling2D, Dense, Dropout, Concatenate
 from keras.layers.advanced_activations import LeakyReLU
+from keras.losses import sparse_categorical_crossentropy
 from keras.models import Model
-from keras.preprocessing.image import ImageDataGenerator
 from keras.regularizers import l2
+from keras.utils import Sequence
+from keras import backend as K
 
-from model_utils import import_folder_to_numpy_array, single_class_accuracy, build_stem_cnn_block
-from config import CLASS_DICT, CHANNELS, COLOR_TYPE, IMAGE_SIZE, DEFAULT_OPTIMIZER
+from model_utils import import_folder_to_numpy_array, single_class_accuracy, build_stem_cnn_block, \
+    configure_backend_session, stratified_split, fuse_conv_batchnorm, evaluate_quantized_model, \
+    reinitialize_model_weights, ImageAugmentation, build_rescaling_layer
+from config import CLASS_DICT, COLOR_TYPE, IMAGE_SIZE, INPUT_SIZE, DEFAULT_OPTIMIZER
+
+try:
+    import horovod.keras as hvd
+except ImportError:
+    hvd = None
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# Built models keyed by their construction arguments - rebuilding the same architecture
+# repeats hundreds of layer constructions and, with JIT enabled, an XLA recompilation,
+# so builders hand back the cached graph with freshly drawn weights instead
+_MODEL_CACHE = {}
+
 
 def build_simple_cnn_model_with_dropout(
         input_size=None,
@@ -25,7 +43,9 @@ def build_simple_cnn_model_with_dropout(
         dropout_rate=0.5,
         nb_of_residual_blocks_in_first_path=4,
         nb_of_residual_blocks_in_second_path=3,
-        freeze_batch=False):
+        freeze_batch=False,
+        optimizer=None,
+        augment=False):
     """
     This function builds a simple model with dropout.
     :param input_size: Size of the input image (if None - default values are used).
@@ -34,14 +54,28 @@ def build_simple_cnn_model_with_dropout(
     :param nb_of_residual_blocks_in_first_path: Number of residual blocks in the first path.
     :param nb_of_residual_blocks_in_second_path: Number of residual blocks in the second path.
     :param freeze_batch: Flag deciding if batch normalization should be frozen for variational inference.
-    :return: A compiled model.
+    :param optimizer: Optimizer used for compilation (if None - the default one is used).
+    :param augment: Flag deciding if in-graph augmentation should be applied during training.
+    :return: A compiled model - a cached instance with freshly drawn weights when the same
+             architecture was already built in this process.
     """
+    cache_key = ('dropout', input_size, dropout_layer, dropout_rate,
+                 nb_of_residual_blocks_in_first_path, nb_of_residual_blocks_in_second_path,
+                 freeze_batch, optimizer, augment)
+    if cache_key in _MODEL_CACHE:
+        cached_model = _MODEL_CACHE[cache_key]
+        reinitialize_model_weights(cached_model)
+        return cached_model
+
     if input_size is None:
-        input_size = (IMAGE_SIZE[0], IMAGE_SIZE[1], CHANNELS)
+        input_size = INPUT_SIZE
 
     input_tensor = Input(shape=input_size)
 
-    acc_tensor = input_tensor
+    acc_tensor = build_rescaling_layer()(input_tensor)
+    if augment:
+        acc_tensor = ImageAugmentation(name='augmentation')(acc_tensor)
+
     # Stem part
     acc_tensor = build_stem_cnn_block(
         input_tensor_=acc_tensor,
@@ -80,11 +114,12 @@ def build_simple_cnn_model_with_dropout(
     simple_model_with_dropout = Model(input_tensor, [main_output, aux_output])
 
     simple_model_with_dropout.compile(
-        optimizer=DEFAULT_OPTIMIZER,
+        optimizer=optimizer if optimizer is not None else DEFAULT_OPTIMIZER,
         loss="sparse_categorical_crossentropy",
         loss_weights={"main_output": 0.9, "aux_output": 0.1},
         metrics=["acc", single_class_accuracy(0)])
 
+    _MODEL_CACHE[cache_key] = simple_model_with_dropout
     return simple_model_with_dropout
 
 
@@ -145,14 +180,27 @@ def create_residual_block(pooling, freeze_batch=False, filter_nb=64, filter_size
 def build_simple_cnn_model(
         input_size=None,
         nb_of_residual_blocks_in_first_path=4,
-        nb_of_residual_blocks_in_second_path=4,):
+        nb_of_residual_blocks_in_second_path=4,
+        optimizer=None,
+        augment=False):
+
+    cache_key = ('simple', input_size,
+                 nb_of_residual_blocks_in_first_path, nb_of_residual_blocks_in_second_path,
+                 optimizer, augment)
+    if cache_key in _MODEL_CACHE:
+        cached_model = _MODEL_CACHE[cache_key]
+        reinitialize_model_weights(cached_model)
+        return cached_model
 
     if input_size is None:
-        input_size = (IMAGE_SIZE[0], IMAGE_SIZE[1], CHANNELS)
+        input_size = INPUT_SIZE
 
     input_tensor = Input(shape=input_size)
 
-    acc_tensor = input_tensor
+    acc_tensor = build_rescaling_layer()(input_tensor)
+    if augment:
+        acc_tensor = ImageAugmentation(name='augmentation')(acc_tensor)
+
     # Stem part
     acc_tensor = build_stem_cnn_block(
         input_tensor_=acc_tensor,
@@ -182,17 +230,100 @@ def build_simple_cnn_model(
         output_name='main_output')(acc_tensor)
     simple_model = Model(input_tensor, [main_output, aux_output])
 
-    simple_model.compile(optimizer=DEFAULT_OPTIMIZER,
+    simple_model.compile(optimizer=optimizer if optimizer is not None else DEFAULT_OPTIMIZER,
                          loss="sparse_categorical_crossentropy",
                          loss_weights={"main_output": 0.9, "aux_output": 0.1},
                          metrics=["acc", single_class_accuracy(0)])
 
+    _MODEL_CACHE[cache_key] = simple_model
     return simple_model
 
 
-def multioutput_generator(gen, nb_of_outputs=2):
-    for x, y in gen:
-        yield x, [y] * nb_of_outputs
+def build_single_target_model(two_head_model, main_weight=0.9, aux_weight=0.1, optimizer=None):
+    """
+    This function wraps a two-head model so that it trains against a single label array.
+    The two softmax outputs are concatenated into one tensor scored by a combined weighted
+    loss, so a data pipeline can feed plain (x, y) batches without duplicating the labels
+    per output head. The wrapper shares its layers and weights with the original model.
+    :param two_head_model: A model with main and auxiliary softmax outputs.
+    :param main_weight: Weight of the main output in the combined loss.
+    :param aux_weight: Weight of the auxiliary output in the combined loss.
+    :param optimizer: Optimizer used for compilation (if None - the default one is used).
+    :return: A compiled single-output wrapper of the model.
+    """
+    main_output, aux_output = two_head_model.outputs
+    nb_of_classes = K.int_shape(main_output)[-1]
+    combined_output = Concatenate(name='combined_output')([main_output, aux_output])
+
+    def combined_loss(y_true, y_pred):
+        main_prediction = y_pred[:, :nb_of_classes]
+        aux_prediction = y_pred[:, nb_of_classes:]
+        return main_weight * sparse_categorical_crossentropy(y_true, main_prediction) \
+            + aux_weight * sparse_categorical_crossentropy(y_true, aux_prediction)
+
+    single_target_model = Model(two_head_model.input, combined_output)
+    single_target_model.compile(
+        optimizer=optimizer if optimizer is not None else DEFAULT_OPTIMIZER,
+        loss=combined_loss)
+
+    return single_target_model
+
+
+class ArrayBatchSequence(Sequence):
+    """
+    This class serves shuffled batches straight from label and image arrays. Unlike
+    ImageDataGenerator.flow it never casts the whole dataset to float32 - the images stay
+    uint8 (possibly memory-mapped) and only the served batch is converted by the input feed.
+    """
+    def __init__(self, x, y, sample_weight=None, batch_size=32, shuffle=True, seed=None):
+        self.x = x
+        self.y = y
+        self.sample_weight = sample_weight
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.indices = np.arange(x.shape[0])
+        if shuffle:
+            self.random_state.shuffle(self.indices)
+
+    def __len__(self):
+        return (self.x.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, index):
+        # Sorted batch indices keep reads sequential for memory-mapped images
+        batch_indices = np.sort(self.indices[index * self.batch_size:(index + 1) * self.batch_size])
+        if self.sample_weight is not None:
+            return self.x[batch_indices], self.y[batch_indices], self.sample_weight[batch_indices]
+        return self.x[batch_indices], self.y[batch_indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random_state.shuffle(self.indices)
+
+
+class MultiOutputSequence(Sequence):
+    """
+    This class wraps a batch iterator so that its labels are fed to every output of a multi-output model.
+    Unlike a plain Python generator it keeps index-based batch access, so Keras can enqueue
+    batches in order and prefetch them instead of pulling them one by one from a generator.
+    """
+    def __init__(self, iterator, nb_of_outputs=2):
+        self.iterator = iterator
+        self.nb_of_outputs = nb_of_outputs
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __getitem__(self, index):
+        batch = self.iterator[index]
+        if len(batch) == 3:
+            x, y, sample_weight = batch
+            return x, [y] * self.nb_of_outputs, [sample_weight] * self.nb_of_outputs
+        x, y = batch
+        return x, [y] * self.nb_of_outputs
+
+    def on_epoch_end(self):
+        self.iterator.on_epoch_end()
 
 
 class RestartCallback(Callback):
@@ -229,59 +360,58 @@ def train_cycle(datasets_path, output_dir, epochs):
     SEED = 42
     EPOCHS = epochs
 
+    if hvd is not None:
+        hvd.init()
+        configure_backend_session(gpu_device=hvd.local_rank())
+    else:
+        configure_backend_session()
+
     test_path = os.path.join(datasets_path, "test")
     train_path = os.path.join(datasets_path, "train")
 
-    base_generator = ImageDataGenerator(rescale=1.0 / 255,
-                                        horizontal_flip=True,
-                                        vertical_flip=True,
-                                        rotation_range=90,
-                                        zoom_range=0.4,
-                                        width_shift_range=0.1,
-                                        height_shift_range=0.1)
-
-    base_valid_generator = ImageDataGenerator(rescale=1.0/255)
-
     train_x, train_y = import_folder_to_numpy_array(
         folder_path=train_path,
         target_size=IMAGE_SIZE,
         color_mode=COLOR_TYPE,
-        class_dict=CLASS_DICT
+        class_dict=CLASS_DICT,
+        cache_path=os.path.join(output_dir, "train_cache")
     )
 
     test_x, test_y = import_folder_to_numpy_array(
         folder_path=test_path,
         target_size=IMAGE_SIZE,
         color_mode=COLOR_TYPE,
-        class_dict=CLASS_DICT
+        class_dict=CLASS_DICT,
+        cache_path=os.path.join(output_dir, "test_cache")
     )
 
-    import math
-
-    label_indices = {}
-    for i in range(0, train_y.shape[0]):
-        if not train_y[i] in label_indices:
-            label_indices[train_y[i]] = []
-
-        label_indices[train_y[i]].append(i)
+    if K.image_data_format() == 'channels_first':
+        train_x = np.transpose(train_x, (0, 3, 1, 2))
+        test_x = np.transpose(test_x, (0, 3, 1, 2))
 
-    train_indices = []
-    val_indices = []
-    for key, value in label_indices.items():
-        train_size = math.floor(0.7 * len(value))
-        for index1 in value[:train_size]:
-            train_indices.append(index1)
-        for index2 in value[train_size:]:
-            val_indices.append(index2)
+    train_indices, val_indices = stratified_split(train_y, train_ratio=0.7)
 
     valid_x = train_x[val_indices]
     valid_y = train_y[val_indices]
     train_x = train_x[train_indices]
     train_y = train_y[train_indices]
     
-    train_generator = base_generator.flow(train_x, train_y, batch_size=TRAIN_BATCH_SIZE, seed=SEED)
-    valid_generator = base_valid_generator.flow(valid_x, valid_y, batch_size=TEST_BATCH_SIZE, seed=SEED)
-    test_generator = base_valid_generator.flow(test_x, test_y, batch_size=TEST_BATCH_SIZE, seed=SEED)
+    # Per-class weights, applied as a precomputed per-sample weight vector - unlike a
+    # class_weight dict, this is resolved once up front instead of per batch
+    class_weight_vector = np.ones(len(CLASS_DICT), dtype=K.floatx())
+    train_sample_weights = class_weight_vector[train_y]
+
+    # Each Horovod rank shuffles with its own seed - with train_steps divided by the worker
+    # count below, a shared seed would make every rank consume the same first slice of the
+    # same permutation and average N identical gradients
+    train_seed = SEED if hvd is None else SEED + hvd.rank()
+
+    # Rescaling and affine augmentation happen in-graph (see build_rescaling_layer and
+    # build_augmentation_layer), the sequences only shuffle and batch the uint8 arrays
+    train_generator = ArrayBatchSequence(train_x, train_y, sample_weight=train_sample_weights,
+                                         batch_size=TRAIN_BATCH_SIZE, seed=train_seed)
+    valid_generator = ArrayBatchSequence(valid_x, valid_y, batch_size=TEST_BATCH_SIZE, shuffle=False)
+    test_generator = ArrayBatchSequence(test_x, test_y, batch_size=TEST_BATCH_SIZE, shuffle=False)
 
     experiment_name = "ara_cnn"
 
@@ -299,48 +429,77 @@ def train_cycle(datasets_path, output_dir, epochs):
         monitor="main_output_loss",
         value=THRESHOLD_LOSS_VALUE_2, )
 
-    class_weights = {0: 1,
-                     1: 1,
-                     2: 1,
-                     3: 1,
-                     4: 1,
-                     5: 1,
-                     6: 1,
-                     7: 1}
+    optimizer = DEFAULT_OPTIMIZER
+    nb_of_workers = 1
+    callbacks = [restarter_1, restarter_2]
+    if hasattr(optimizer, 'lr'):
+        # The TF-native fused optimizer exposes no Keras-visible learning rate to reduce
+        callbacks = [reducer] + callbacks
+    if hvd is None or hvd.rank() == 0:
+        # Only one worker should write checkpoints and TensorBoard logs.
+        callbacks = [checkpointer, tensorboard] + callbacks
+    if hvd is not None:
+        optimizer = hvd.DistributedOptimizer(optimizer)
+        nb_of_workers = hvd.size()
+        callbacks = [hvd.callbacks.BroadcastGlobalVariablesCallback(0),
+                     hvd.callbacks.MetricAverageCallback()] + callbacks
+
+    model = build_simple_cnn_model_with_dropout(optimizer=optimizer, augment=True)
+
+    # Step counts only depend on the split sizes, so they are computed once before the
+    # restart loop; the negated floor division is an integer ceiling
+    train_steps = train_x.shape[0] // (TRAIN_BATCH_SIZE * nb_of_workers)
+    validation_steps = -(-valid_x.shape[0] // TEST_BATCH_SIZE)
 
     while True:
-        model = build_simple_cnn_model_with_dropout()
-        history = model.fit_generator(multioutput_generator(train_generator),
-                                      steps_per_epoch=int(train_x.shape[0] / TRAIN_BATCH_SIZE),
+        history = model.fit_generator(MultiOutputSequence(train_generator),
+                                      steps_per_epoch=train_steps,
                                       epochs=EPOCHS,
-                                      validation_data=multioutput_generator(valid_generator),
-                                      validation_steps=int(math.ceil(valid_x.shape[0] / TEST_BATCH_SIZE)),
-                                      class_weight=class_weights,
-                                      callbacks=[checkpointer, reducer, tensorboard, restarter_1, restarter_2],
+                                      validation_data=MultiOutputSequence(valid_generator),
+                                      validation_steps=validation_steps,
+                                      callbacks=callbacks,
+                                      workers=max(1, cpu_count() // 2),
+                                      use_multiprocessing=True,
+                                      max_queue_size=32,
                                       verbose=1)
         if not restarter_1.stopped or restarter_2.stopped:
             break
 
-    eval_result = model.evaluate_generator(multioutput_generator(test_generator),
-                                           steps=int(test_x.shape[0] / TEST_BATCH_SIZE))
-
-    with open(output_dir + "/" + experiment_name + ".txt", "w") as destination:
-        destination.write('epoch_nr, loss, main_output_loss, aux_output_loss, main_output_acc, aux_output_acc, val_loss, val_main_output_loss, val_aux_output_loss, val_main_output_acc, val_aux_output_acc, eval_main_acc, eval_aux_acc\n')
-        for epoch_nr in range(len(history.history["loss"])):
-            destination.write("%d, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f\n" % (
-                epoch_nr + 1,
-                history.history["loss"][epoch_nr],
-                history.history["main_output_loss"][epoch_nr],
-                history.history["aux_output_loss"][epoch_nr],
-                history.history["main_output_acc"][epoch_nr],
-                history.history["aux_output_acc"][epoch_nr],
-                history.history["val_loss"][epoch_nr],
-                history.history["val_main_output_loss"][epoch_nr],
-                history.history["val_aux_output_loss"][epoch_nr],
-                history.history["val_main_output_acc"][epoch_nr],
-                history.history["val_aux_output_acc"][epoch_nr],
-                eval_result[3], #eval_main_acc
-                eval_result[5])) #eval_aux_acc
+        # Fresh random weights for the next attempt, without rebuilding and recompiling the graph
+        reinitialize_model_weights(model)
+
+    # Evaluation runs on a copy built in inference mode, with every Conv+BatchNormalization pair
+    # fused into a single kernel
+    K.set_learning_phase(0)
+    inference_model = fuse_conv_batchnorm(model)
+    test_steps = int(test_x.shape[0] / TEST_BATCH_SIZE)
+
+    try:
+        eval_main_acc, eval_aux_acc = evaluate_quantized_model(inference_model, test_generator, test_steps)
+    except Exception:
+        logger.warning("Quantized evaluation failed, falling back to float evaluation.", exc_info=True)
+        inference_model.compile(
+            optimizer=DEFAULT_OPTIMIZER,
+            loss="sparse_categorical_crossentropy",
+            loss_weights={"main_output": 0.9, "aux_output": 0.1},
+            metrics=["acc", single_class_accuracy(0)])
+        eval_result = inference_model.evaluate_generator(MultiOutputSequence(test_generator),
+                                                         steps=test_steps)
+        eval_main_acc, eval_aux_acc = eval_result[3], eval_result[5]
+
+    history_keys = ["loss", "main_output_loss", "aux_output_loss", "main_output_acc", "aux_output_acc",
+                    "val_loss", "val_main_output_loss", "val_aux_output_loss", "val_main_output_acc",
+                    "val_aux_output_acc"]
+    nb_of_epochs = len(history.history["loss"])
+    history_table = np.column_stack(
+        [np.arange(1, nb_of_epochs + 1)]
+        + [history.history[key] for key in history_keys]
+        + [np.full(nb_of_epochs, eval_main_acc), np.full(nb_of_epochs, eval_aux_acc)])
+    np.savetxt(output_dir + "/" + experiment_name + ".txt",
+               history_table,
+               fmt="%d, " + ", ".join(["%f"] * 12),
+               header='epoch_nr, loss, main_output_loss, aux_output_loss, main_output_acc, aux_output_acc, val_loss, val_main_output_loss, val_aux_output_loss, val_main_output_acc, val_aux_output_acc, eval_main_acc, eval_aux_acc',
+               comments='')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
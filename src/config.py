@@ -1,10 +1,41 @@
-from keras.optimizers import Adam
+import tensorflow
+
+from keras import backend
+from keras.optimizers import Adam, TFOptimizer
+from tensorflow.python.client import device_lib
+
+
+def _gpu_is_available():
+    """
+    A helper function checking whether a GPU is actually usable at runtime, not merely
+    compiled in. The device probe carries allow_growth, so the per-GPU allocators it
+    creates do not reserve all GPU memory for the whole process lifetime.
+    :return: True when at least one GPU device is present.
+    """
+    if not tensorflow.test.is_built_with_cuda():
+        return False
+    probe_config = tensorflow.ConfigProto()
+    probe_config.gpu_options.allow_growth = True
+    return any(device.device_type == 'GPU' for device in device_lib.list_local_devices(probe_config))
+
 
 # General image options
 IMAGE_SIZE = (128, 128)  # input images are scaled to this resolution
 COLOR_TYPE = 'rgb'  # change to grayscale if your images are monochrome
 CHANNELS = 1 if COLOR_TYPE == 'grayscale' else 3
 
+# Image data format - 'channels_first' (NCHW) is the native layout of the fast cuDNN conv
+# kernels; TF ships no NCHW conv kernels for CPU, so the format is only switched when a GPU
+# is actually usable at runtime
+IMAGE_DATA_FORMAT = 'channels_first' if _gpu_is_available() else 'channels_last'
+backend.set_image_data_format(IMAGE_DATA_FORMAT)
+
+# Model input size matching the selected data format
+if IMAGE_DATA_FORMAT == 'channels_first':
+    INPUT_SIZE = (CHANNELS, IMAGE_SIZE[0], IMAGE_SIZE[1])
+else:
+    INPUT_SIZE = (IMAGE_SIZE[0], IMAGE_SIZE[1], CHANNELS)
+
 # Main class dictionary - this needs to match folder names in your training dataset
 CLASS_DICT = {
     "01_TUMOR": 0,
@@ -17,8 +48,26 @@ CLASS_DICT = {
     "08_EMPTY": 7,
 }
 
+# Float precision used for training - 'float16' halves activation memory bandwidth and enables
+# half-precision conv kernels on supporting GPUs, but there is no loss scaling in this Keras
+# version, so it stays opt-in. Applied here, before the optimizer below is built, so its
+# hyperparameter variables are created in the selected precision
+FLOATX = 'float32'
+backend.set_floatx(FLOATX)
+if FLOATX == 'float16':
+    # The default fuzz factor underflows in half precision
+    backend.set_epsilon(1e-4)
+
+# Flag selecting the TF-native Adam, whose update runs as one fused kernel per variable
+# instead of many small elementwise ops; it does not expose a Keras-visible learning rate,
+# so learning-rate schedules are skipped when it is enabled
+USE_FUSED_OPTIMIZER = False
+
 # Default optimizer
-DEFAULT_OPTIMIZER = Adam()
+if USE_FUSED_OPTIMIZER:
+    DEFAULT_OPTIMIZER = TFOptimizer(tensorflow.train.AdamOptimizer(learning_rate=1e-3))
+else:
+    DEFAULT_OPTIMIZER = Adam(lr=1e-3)
 
 # Cliping EPS
 EPS = 1e-6
@@ -1,13 +1,35 @@
+import hashlib
 import numpy
 import os
 
-from keras.layers import BatchNormalization, Conv2D, MaxPooling2D
+from multiprocessing.pool import ThreadPool
+
+import tensorflow as tf
+
+from keras.layers import BatchNormalization, Conv2D, Lambda, Layer, MaxPooling2D
 from keras.layers.advanced_activations import LeakyReLU
+from keras.models import Model
 from keras.preprocessing.image import load_img, img_to_array
 from keras.regularizers import l2
 
 from keras import backend as K
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def maybe_njit(function):
+    """
+    A helper decorator applying numba JIT compilation when numba is available.
+    :param function: A function to compile.
+    :return: The compiled function, or the function itself if numba is not installed.
+    """
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
 
 class EmptyImagesFolder(Exception):
     pass
@@ -21,14 +43,85 @@ def load_all_images_from_folder(folder_path, target_size, color_mode, image_exte
     if len(list_of_images_path) == 0:
         raise EmptyImagesFolder
 
-    # Getting list of images
-    list_of_images = [img_to_array(load_img(path=path, grayscale=(color_mode == "grayscale"), target_size=target_size))
-                      for path in list_of_images_path]
+    # Getting list of images - decoded in a thread pool, since PIL releases the GIL
+    # this overlaps file reads and JPEG decoding across cores
+    def _load_image(path):
+        return img_to_array(load_img(path=path, grayscale=(color_mode == "grayscale"), target_size=target_size))
+
+    pool = ThreadPool()
+    try:
+        list_of_images = pool.map(_load_image, list_of_images_path)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Raw pixels are kept as uint8 - 4x smaller than float32 - and rescaled inside the graph
+    return numpy.array(list_of_images, dtype=numpy.uint8)
+
+
+def _dataset_fingerprint(folder_path):
+    """
+    A helper function computing a cheap fingerprint of a dataset folder: its absolute path
+    plus the relative path, size and modification time of every file under it. The images
+    are not read, so the fingerprint costs one directory walk.
+    :param folder_path: Path to the dataset folder.
+    :return: A hex digest string.
+    """
+    digest = hashlib.md5(os.path.abspath(folder_path).encode('utf-8'))
+    for dir_path, dir_names, file_names in os.walk(folder_path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_stat = os.stat(os.path.join(dir_path, file_name))
+            entry = "%s:%d:%d" % (os.path.relpath(os.path.join(dir_path, file_name), folder_path),
+                                  file_stat.st_size, int(file_stat.st_mtime))
+            digest.update(entry.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _cache_matches(images_array, labels_array, target_size, color_mode, class_dict,
+                   fingerprint_path, dataset_fingerprint):
+    """
+    A helper function checking whether cached arrays match the requested import parameters
+    and whether the source dataset is unchanged since the cache was written.
+    :param images_array: A cached images array.
+    :param labels_array: A cached labels array.
+    :param target_size: Requested (height, width) of the images.
+    :param color_mode: Requested color mode - 'grayscale' or 'rgb'.
+    :param class_dict: Mapping of class names to labels, or None.
+    :param fingerprint_path: Path to the fingerprint file written next to the cached arrays.
+    :param dataset_fingerprint: Fingerprint of the dataset folder being imported.
+    :return: True when the cache can be reused as-is.
+    """
+    channels = 1 if color_mode == "grayscale" else 3
+    if images_array.ndim != 4 or images_array.shape[1:] != (target_size[0], target_size[1], channels):
+        return False
+    if images_array.shape[0] != labels_array.shape[0]:
+        return False
+    if class_dict is not None and not set(numpy.unique(labels_array)) <= set(class_dict.values()):
+        return False
+    if not os.path.exists(fingerprint_path):
+        return False
+    with open(fingerprint_path) as fingerprint_file:
+        return fingerprint_file.read().strip() == dataset_fingerprint
+
 
-    return numpy.array(list_of_images)
+def import_folder_to_numpy_array(folder_path, target_size, color_mode, binary=False, class_dict=None,
+                                 cache_path=None):
+    if cache_path is not None:
+        dataset_fingerprint = _dataset_fingerprint(folder_path)
 
+    # Reusing already decoded images when cache files from a previous run exist; the images
+    # are memory-mapped, so they stay on disk until batches actually touch them. A cache
+    # written with different image or class settings, from another dataset folder or before
+    # the dataset changed on disk is re-decoded instead of silently reused
+    if cache_path is not None and os.path.exists(cache_path + "_images.npy"):
+        cached_images = numpy.load(cache_path + "_images.npy", mmap_mode='r')
+        cached_labels = numpy.load(cache_path + "_labels.npy")
+        if _cache_matches(cached_images, cached_labels, target_size, color_mode, class_dict,
+                          cache_path + "_fingerprint.txt", dataset_fingerprint):
+            return cached_images, cached_labels
 
-def import_folder_to_numpy_array(folder_path, target_size, color_mode, binary=False, class_dict=None):
     # Preparations of accumulative variables
     classes = os.listdir(folder_path)
     arrays_list = list()
@@ -63,9 +156,73 @@ def import_folder_to_numpy_array(folder_path, target_size, color_mode, binary=Fa
     images_array = numpy.concatenate(arrays_list)
     labels_array = numpy.array(labels)
 
+    # Filling the cache so the next run skips listing and decoding the images
+    if cache_path is not None:
+        numpy.save(cache_path + "_images.npy", images_array)
+        numpy.save(cache_path + "_labels.npy", labels_array)
+        with open(cache_path + "_fingerprint.txt", "w") as fingerprint_file:
+            fingerprint_file.write(dataset_fingerprint)
+
     return images_array, labels_array
 
 
+def configure_backend_session(gpu_device=None):
+    """
+    This function installs a Keras backend session with XLA JIT compilation enabled.
+    XLA fuses the Conv->BatchNormalization->LeakyReLU->Add chains of the residual blocks
+    into a few compiled kernels, which removes most of the per-op dispatch overhead.
+    :param gpu_device: Index of the only GPU the session should see (if None - all GPUs are visible).
+    """
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.allow_growth = True
+    if gpu_device is not None:
+        session_config.gpu_options.visible_device_list = str(gpu_device)
+    session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    K.set_session(tf.Session(config=session_config))
+
+
+@maybe_njit
+def stratified_split(labels, train_ratio):
+    """
+    This function splits sample indices into train and validation parts, stratified per class.
+    Classes are grouped with a stable argsort and the index arrays are preallocated and filled
+    in two passes (count, then fill), which numba compiles to tight native loops.
+    :param labels: A 1-D array of class labels.
+    :param train_ratio: Fraction of each class assigned to the train part.
+    :return: A tuple of (train_indices, validation_indices) arrays.
+    """
+    order = numpy.argsort(labels, kind='mergesort')
+    nb_of_samples = labels.shape[0]
+
+    # First pass - counting how many samples land in the train part of every class run
+    nb_of_train = 0
+    start = 0
+    for i in range(1, nb_of_samples + 1):
+        if i == nb_of_samples or labels[order[i]] != labels[order[start]]:
+            nb_of_train += int(train_ratio * (i - start))
+            start = i
+
+    train_indices = numpy.empty(nb_of_train, dtype=numpy.int64)
+    validation_indices = numpy.empty(nb_of_samples - nb_of_train, dtype=numpy.int64)
+
+    # Second pass - filling the preallocated index arrays class by class
+    train_position = 0
+    validation_position = 0
+    start = 0
+    for i in range(1, nb_of_samples + 1):
+        if i == nb_of_samples or labels[order[i]] != labels[order[start]]:
+            train_size = int(train_ratio * (i - start))
+            for j in range(start, start + train_size):
+                train_indices[train_position] = order[j]
+                train_position += 1
+            for j in range(start + train_size, i):
+                validation_indices[validation_position] = order[j]
+                validation_position += 1
+            start = i
+
+    return train_indices, validation_indices
+
+
 def single_class_accuracy(interesting_class_id):
     """
     This function creates a Keras metric with single class accuracy for a class provided.
@@ -109,14 +266,88 @@ def build_stem_cnn_block(
         strides=strides,
         kernel_initializer="he_normal",
         kernel_regularizer=l2(l2_param))(input_tensor_)
-    block_acc_tensor = BatchNormalization()(block_acc_tensor) if not freeze_batch \
-        else NonTrainableBatchNormalization()(block_acc_tensor)
+    # Batch normalization does not pick the data format up from the backend, so the channel
+    # axis has to be set explicitly
+    batch_norm_axis = 1 if K.image_data_format() == 'channels_first' else -1
+    block_acc_tensor = BatchNormalization(axis=batch_norm_axis)(block_acc_tensor) if not freeze_batch \
+        else NonTrainableBatchNormalization(axis=batch_norm_axis)(block_acc_tensor)
     block_acc_tensor = LeakyReLU(alpha=alpha)(block_acc_tensor)
     if pooling:
         block_acc_tensor = MaxPooling2D(pooling_size)(block_acc_tensor)
     return block_acc_tensor
 
 
+def build_rescaling_layer(scale=1.0 / 255):
+    """
+    This function builds a layer rescaling raw pixel values inside the graph, so image
+    arrays can stay uint8 until they reach the model input feed.
+    :param scale: Multiplier applied to the input pixels.
+    :return: A Lambda layer applying the rescaling.
+    """
+    return Lambda(lambda images: images * scale, name='rescaling')
+
+
+class ImageAugmentation(Layer):
+    """
+    This layer replicates the ImageDataGenerator affine augmentation (flips, rotation,
+    zoom and shift) in-graph. The ops process a whole batch per kernel call and run on the
+    same device as the model, and the layer passes its input through untouched outside the
+    training phase. It is a real Layer subclass (not a Lambda with nested helpers), so
+    models containing it serialize and reload cleanly through custom_objects.
+    """
+    def __init__(self, rotation_range=90, zoom_range=0.4, shift_range=0.1, **kwargs):
+        super(ImageAugmentation, self).__init__(**kwargs)
+        self.rotation_range = rotation_range
+        self.zoom_range = zoom_range
+        self.shift_range = shift_range
+
+    def _augment_batch(self, images):
+        batch_size = tf.shape(images)[0]
+
+        flip_horizontal = tf.random_uniform([batch_size]) < 0.5
+        images = tf.where(flip_horizontal, tf.reverse(images, [2]), images)
+        flip_vertical = tf.random_uniform([batch_size]) < 0.5
+        images = tf.where(flip_vertical, tf.reverse(images, [1]), images)
+
+        angles = tf.random_uniform([batch_size], -self.rotation_range, self.rotation_range) \
+            * (numpy.pi / 180.0)
+        images = tf.contrib.image.rotate(images, angles, interpolation='BILINEAR')
+
+        image_size = tf.cast(tf.shape(images)[1:3], tf.float32)
+        zooms = tf.random_uniform([batch_size, 2], 1.0 - self.zoom_range, 1.0 + self.zoom_range)
+        shifts = tf.random_uniform([batch_size, 2], -self.shift_range, self.shift_range) * image_size
+        zeros = tf.zeros([batch_size])
+        # Per-image affine rows [a0, a1, a2, b0, b1, b2, c0, c1] mapping output to input
+        # coordinates; the (1 - zoom) * size / 2 offsets keep the zoom centered on the image
+        # the way ImageDataGenerator centers its transforms
+        transforms = tf.stack([
+            zooms[:, 1], zeros, (1.0 - zooms[:, 1]) * image_size[1] / 2.0 + shifts[:, 1],
+            zeros, zooms[:, 0], (1.0 - zooms[:, 0]) * image_size[0] / 2.0 + shifts[:, 0],
+            zeros, zeros], axis=1)
+        return tf.contrib.image.transform(images, transforms, interpolation='BILINEAR')
+
+    def call(self, inputs, training=None):
+        # The batched image ops expect channels_last input
+        if K.image_data_format() == 'channels_first':
+            augmented = tf.transpose(inputs, [0, 2, 3, 1])
+            augmented = tf.transpose(self._augment_batch(augmented), [0, 3, 1, 2])
+        else:
+            augmented = self._augment_batch(inputs)
+        return K.in_train_phase(augmented, inputs, training=training)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {
+            'rotation_range': self.rotation_range,
+            'zoom_range': self.zoom_range,
+            'shift_range': self.shift_range,
+        }
+        base_config = super(ImageAugmentation, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 class NonTrainableBatchNormalization(BatchNormalization):
     """
     This class makes possible to freeze batch normalization while Keras is in training phase.
@@ -125,6 +356,138 @@ class NonTrainableBatchNormalization(BatchNormalization):
         return super(NonTrainableBatchNormalization, self).call(inputs, training=False)
 
 
+def reinitialize_model_weights(model):
+    """
+    This function draws fresh random weights for a model by re-running its variable
+    initializers, without rebuilding or recompiling the graph. Optimizer state is
+    reset as well when present.
+    :param model: A built (and possibly compiled) model.
+    """
+    weights = list(model.weights)
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is not None:
+        try:
+            weights = weights + list(optimizer.weights)
+        except NotImplementedError:
+            # TFOptimizer exposes no Keras-visible slot variables
+            pass
+    K.get_session().run([weight.initializer for weight in weights])
+
+
+def _fold_batch_normalization(conv_layer, batch_norm_layer):
+    """
+    A helper function computing convolution weights with a following batch normalization folded in.
+    :param conv_layer: A convolution layer.
+    :param batch_norm_layer: The batch normalization layer applied directly to the convolution output.
+    :return: A list of [kernel, bias] weights for the fused convolution.
+    """
+    gamma, beta, moving_mean, moving_variance = batch_norm_layer.get_weights()
+    scale = gamma / numpy.sqrt(moving_variance + batch_norm_layer.epsilon)
+    conv_weights = conv_layer.get_weights()
+    kernel = conv_weights[0] * scale
+    bias = conv_weights[1] if conv_layer.use_bias else 0.0
+    return [kernel, (bias - moving_mean) * scale + beta]
+
+
+def fuse_conv_batchnorm(model):
+    """
+    This function builds an inference copy of a model with every batch normalization layer
+    that directly follows a convolution folded into the convolution weights. The fused copy
+    computes the same outputs with one kernel less per stem block, which speeds up evaluation.
+    :param model: A trained model.
+    :return: An uncompiled copy of the model with fused weights.
+    """
+    # Finding (batch normalization -> convolution) pairs which are safe to fold
+    batch_norm_to_conv = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization):
+            continue
+        inbound_layers = layer._inbound_nodes[0].inbound_layers
+        if len(inbound_layers) == 1 and isinstance(inbound_layers[0], Conv2D) \
+                and len(inbound_layers[0]._outbound_nodes) == 1:
+            batch_norm_to_conv[layer.name] = inbound_layers[0].name
+    conv_to_batch_norm = {conv_name: bn_name for bn_name, conv_name in batch_norm_to_conv.items()}
+
+    # Rebuilding the graph with cloned layers, skipping the folded batch normalizations
+    tensor_map = {}
+    new_layers = {}
+    for layer in model.layers:
+        node = layer._inbound_nodes[0]
+        if not node.inbound_layers:
+            new_layer = layer.__class__.from_config(layer.get_config())
+            new_layers[layer.name] = new_layer
+            tensor_map[id(node.output_tensors[0])] = new_layer._inbound_nodes[0].output_tensors[0]
+            continue
+
+        input_tensors = [tensor_map[id(tensor)] for tensor in node.input_tensors]
+        if layer.name in batch_norm_to_conv:
+            tensor_map[id(node.output_tensors[0])] = input_tensors[0]
+            continue
+
+        layer_config = layer.get_config()
+        if layer.name in conv_to_batch_norm:
+            # The fused convolution absorbs the batch normalization shift as its bias
+            layer_config['use_bias'] = True
+        new_layer = layer.__class__.from_config(layer_config)
+        new_layers[layer.name] = new_layer
+        new_output = new_layer(input_tensors if len(input_tensors) > 1 else input_tensors[0])
+        new_outputs = new_output if isinstance(new_output, list) else [new_output]
+        for original_tensor, new_tensor in zip(node.output_tensors, new_outputs):
+            tensor_map[id(original_tensor)] = new_tensor
+
+    fused_model = Model(
+        [tensor_map[id(tensor)] for tensor in model.inputs],
+        [tensor_map[id(tensor)] for tensor in model.outputs])
+
+    # Copying weights, folding batch normalization parameters into their convolutions
+    for layer in model.layers:
+        if layer.name in batch_norm_to_conv:
+            continue
+        if layer.name in conv_to_batch_norm:
+            batch_norm_layer = model.get_layer(conv_to_batch_norm[layer.name])
+            new_layers[layer.name].set_weights(_fold_batch_normalization(layer, batch_norm_layer))
+        elif layer.get_weights():
+            new_layers[layer.name].set_weights(layer.get_weights())
+
+    return fused_model
+
+
+def evaluate_quantized_model(model, generator, steps):
+    """
+    This function evaluates a model with its weights quantized to 8 bits after training.
+    The model is converted with TensorFlow Lite post-training quantization, which shrinks the
+    weights 4x and lets the interpreter use 8-bit SIMD kernels on CPU, and is then run over
+    the generator batches. The model must be built in inference mode (learning phase 0),
+    otherwise the conversion cannot resolve the learning-phase placeholder.
+    :param model: A trained multi-output model.
+    :param generator: A batch iterator yielding (images, labels).
+    :param steps: Number of batches to evaluate.
+    :return: An array with one accuracy per model output.
+    """
+    converter = tf.contrib.lite.TocoConverter.from_session(K.get_session(), model.inputs, model.outputs)
+    converter.post_training_quantize = True
+    quantized_model = converter.convert()
+
+    interpreter = tf.contrib.lite.Interpreter(model_content=quantized_model)
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()
+
+    correct_predictions = numpy.zeros(len(output_details))
+    nb_of_samples = 0
+    for step in range(steps):
+        images, labels = generator[step]
+        interpreter.resize_tensor_input(input_details['index'], images.shape)
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(input_details['index'], images.astype(input_details['dtype']))
+        interpreter.invoke()
+        for output_nb, output_detail in enumerate(output_details):
+            predictions = numpy.argmax(interpreter.get_tensor(output_detail['index']), axis=-1)
+            correct_predictions[output_nb] += numpy.sum(predictions == labels)
+        nb_of_samples += labels.shape[0]
+
+    return correct_predictions / nb_of_samples
+
+
 def get_dataset_path(dataset_name):
     """
     A helper function for getting a path to a dataset.
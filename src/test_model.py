@@ -5,9 +5,10 @@ import csv
 
 from keras.models import load_model
 from keras.preprocessing.image import load_img, img_to_array
+from keras import backend as K
 
 from variational_dropout import build_variational_model, build_variational_inference_function, compute_table_uncertainty
-from model_utils import import_folder_to_numpy_array, single_class_accuracy
+from model_utils import import_folder_to_numpy_array, single_class_accuracy, ImageAugmentation
 from config import CLASS_DICT, IMAGE_SIZE
 
 
@@ -22,7 +23,8 @@ class ModelLoader(object):
 
     def load_model(self):
         self.trained_model = load_model(self.model_path,
-                                        custom_objects={'fn': single_class_accuracy(0)})
+                                        custom_objects={'fn': single_class_accuracy(0),
+                                                        'ImageAugmentation': ImageAugmentation})
         self.trained_model.summary()
 
     def test_folder_variational(self, test_set_path, measure, max_img_count=1000):
@@ -43,14 +45,16 @@ class ModelLoader(object):
                 load_img(path=os.path.join(test_set_path, img), grayscale=False, target_size=IMAGE_SIZE))
             test_img = test_img[None, ...]
 
-            vectr = np.vectorize(lambda x: x / 255.0)
-            mapped_test_img = vectr(test_img)
+            # Raw pixel values go straight in - the model rescales them in-graph
             if images is None:
-                images = mapped_test_img
+                images = test_img
             else:
-                images = np.append(images, np.array(mapped_test_img), axis=0)
+                images = np.append(images, np.array(test_img), axis=0)
             counter += 1
 
+        if K.image_data_format() == 'channels_first':
+            images = np.transpose(images, (0, 3, 1, 2))
+
         all_p = []
         all_u = []
 
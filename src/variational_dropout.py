@@ -1,6 +1,7 @@
 from config import COLOR_TYPE, CLASS_DICT, IMAGE_SIZE, EPS
 from keras.models import load_model
-from model_utils import single_class_accuracy, import_folder_to_numpy_array, get_dataset_path
+from model_utils import single_class_accuracy, import_folder_to_numpy_array, get_dataset_path, \
+    ImageAugmentation
 from ara_cnn import build_simple_cnn_model_with_dropout
 
 import keras.backend as K
@@ -13,16 +14,20 @@ def load_dropout_model_instance(model_path):
     :param model_path: Path to dropout model.
     :return: A dropout model instance.
     """
-    return load_model(model_path, custom_objects={"fn": single_class_accuracy(0)})
+    return load_model(model_path, custom_objects={"fn": single_class_accuracy(0),
+                                                  "ImageAugmentation": ImageAugmentation})
 
 
 def copy_weights(src_model, dst_model):
     """
-    A helper function for copying weights.
+    A helper function for copying weights. Layers without weights (inputs, activations,
+    in-graph augmentation) are skipped, so the two models do not have to match layer for layer.
     :param src_model: A source model for copying.
     :param dst_model:  A destination model to copying.
     """
-    for src_layer, dst_layer in zip(src_model.layers, dst_model.layers):
+    src_layers = [layer for layer in src_model.layers if layer.get_weights()]
+    dst_layers = [layer for layer in dst_model.layers if layer.get_weights()]
+    for src_layer, dst_layer in zip(src_layers, dst_layers):
         dst_layer.set_weights(src_layer.get_weights())
 
 